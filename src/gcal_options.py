@@ -2,8 +2,15 @@
 Python Script for finding meeting times for shared google calendars.
 See README.md for setup instructions.
 '''
+import bisect
+import concurrent.futures
+import functools
+import hashlib
 import json
+import math
 import os
+import tempfile
+import time
 import datetime
 import zoneinfo
 
@@ -18,18 +25,33 @@ CRED_PATH = os.path.join('configuration', 'credentials.json')
 TOKEN_PATH = os.path.join('configuration', 'token.json')
 EMOJI_PATH = os.path.join('configuration', 'emoji.json')
 PREFS_PATH = os.path.join('configuration', 'preferences.json')
-with open(EMOJI_PATH, 'r', encoding='utf-8') as emoji_file:
-    EMOJI_OPTIONS = json.load(emoji_file)
-with open(PREFS_PATH, 'r', encoding='utf-8') as prefs_file:
-    PREF_OPTIONS = json.load(prefs_file)
+CACHE_PATH = os.path.join('configuration', 'fb_cache')
 
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
-START_OF_DAY = PREF_OPTIONS['EarliestStart']
-END_OF_DAY = PREF_OPTIONS['LatestEnd']
-MEETING_WINDOW = PREF_OPTIONS['LengthOfMeetingWindow']
 WEEKEND_DAYS_AS_INT = [5, 6]
 ATTENDEES = [None]
 EARLIEST_MEETING_TIME = datetime.datetime(2024, 12, 3, tzinfo=datetime.timezone.utc)
+CACHE_TTL_SECONDS = 300
+# The Calendar API accepts at most 50 calls per batch request.
+MAX_BATCH_SIZE = 50
+
+
+@functools.lru_cache(maxsize=None)
+def load_emoji_options() -> list:
+    '''
+    Reads the emoji list on first use.
+    '''
+    with open(EMOJI_PATH, 'r', encoding='utf-8') as emoji_file:
+        return json.load(emoji_file)
+
+
+@functools.lru_cache(maxsize=None)
+def load_preferences() -> dict:
+    '''
+    Reads the user preferences on first use.
+    '''
+    with open(PREFS_PATH, 'r', encoding='utf-8') as prefs_file:
+        return json.load(prefs_file)
 
 
 def api_queries(time_min: datetime.datetime,
@@ -37,6 +59,11 @@ def api_queries(time_min: datetime.datetime,
     '''
     Queries Google Calendar APIs for attendee meeting availabiity. Returns a tuple of user time zones, and their availability.
     '''
+    cache_file = query_cache_file(time_min, time_max)
+    cached_query = read_query_cache(cache_file)
+    if cached_query:
+        return cached_query['calendars'], cached_query['time_zones']
+
     creds = None
     if os.path.exists(TOKEN_PATH):
         creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
@@ -46,171 +73,311 @@ def api_queries(time_min: datetime.datetime,
         else:
             flow = InstalledAppFlow.from_client_secrets_file(CRED_PATH, SCOPES)
             creds = flow.run_local_server(port=0)
-        with open(TOKEN_PATH, "w", encoding='utf-8') as token:
-            token.write(creds.to_json())
+        new_token = creds.to_json()
+        old_token = ''
+        if os.path.exists(TOKEN_PATH):
+            with open(TOKEN_PATH, 'r', encoding='utf-8') as token:
+                old_token = token.read()
+        if new_token != old_token:
+            with open(TOKEN_PATH, "w", encoding='utf-8') as token:
+                token.write(new_token)
 
+    calendars, time_zones = {}, []
     try:
-        time_zones = []
-        service = build('calendar', 'v3', credentials=creds)
-        free_busy = service.freebusy().query(
-            body={
-                'timeMin': time_min.isoformat(),
-                'timeMax': time_max.isoformat(),
-                'items': construct_user_list(ATTENDEES)
-            }).execute()
-        for attendee in ATTENDEES:
-            calendar_object = service.calendars().get(
-                calendarId=attendee).execute()
-            time_zones.append(calendar_object['timeZone'])
-        time_zones = list(set(time_zones))
+        # httplib2 is not thread-safe, so each query builds its own service.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            free_busy_query = executor.submit(query_free_busy, creds, time_min,
+                                              time_max)
+            time_zone_query = executor.submit(query_time_zones, creds)
+            calendars = free_busy_query.result()
+            time_zones = list(dict.fromkeys(time_zone_query.result()))
+        write_query_cache(cache_file, calendars, time_zones)
 
     except HttpError as err:
         print(err)
-    return free_busy['calendars'], time_zones
+    return calendars, time_zones
 
 
-def sort_time_zones(time_zone_list: list) -> list:
+def query_free_busy(creds: Credentials, time_min: datetime.datetime,
+                    time_max: datetime.datetime) -> dict:
     '''
-    Sorts time zones of attendees to normalize display of meeting times from latest
-    local time to earliest local time.
+    Fetches the busy blocks of every attendee within the meeting window.
     '''
-    temp_holder = {}
-    out_list = []
-    for time_zone in time_zone_list:
-        temp_holder[datetime.datetime.now(
-            zoneinfo.ZoneInfo(time_zone)).strftime('%z')] = time_zone
-    for time_key_value_pair in sorted(temp_holder.items()):
-        out_list.append(time_key_value_pair[1])
-    return out_list
+    service = build('calendar', 'v3', credentials=creds)
+    free_busy = service.freebusy().query(
+        body={
+            'timeMin': time_min.isoformat(),
+            'timeMax': time_max.isoformat(),
+            'items': construct_user_list(tuple(ATTENDEES))
+        },
+        fields='calendars').execute()
+    return free_busy['calendars']
 
 
-def prune_weekends(meeting_times: list) -> list:
+def query_time_zones(creds: Credentials) -> list:
     '''
-    Filters availability to only include weekdays.
+    Fetches the time zone of every attendee's calendar in as few batch requests as possible.
     '''
-    valid_times = []
-    for meeting_time in meeting_times:
-        if meeting_time.weekday() not in WEEKEND_DAYS_AS_INT:
-            valid_times.append(meeting_time)
-    return valid_times
+    time_zones = []
+
+    def add_time_zone(_request_id, calendar_object, exception):
+        if exception is not None:
+            raise exception
+        time_zones.append(calendar_object['timeZone'])
 
+    service = build('calendar', 'v3', credentials=creds)
+    for batch_start in range(0, len(ATTENDEES), MAX_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=add_time_zone)
+        for attendee in ATTENDEES[batch_start:batch_start + MAX_BATCH_SIZE]:
+            batch.add(service.calendars().get(calendarId=attendee,
+                                              fields='timeZone'))
+        batch.execute()
+    return time_zones
 
-def construct_user_list(attendees: list) -> list:
+
+def query_cache_file(time_min: datetime.datetime,
+                     time_max: datetime.datetime) -> str:
     '''
-    Converts list of atendees into dict expected by Google Calendar API.
+    Builds the cache file path for the current attendees and meeting window.
     '''
-    calendar_list = []
-    for attendee in attendees:
-        calendar_list.append({'id': attendee})
-    return calendar_list
+    key = hashlib.sha1(
+        f"{sorted(ATTENDEES)}|{time_min.isoformat()}|{time_max.isoformat()}".
+        encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_PATH, f'{key}.json')
 
 
-def get_availability(busy_times: list[dict]) -> list[dict]:
+def read_query_cache(cache_file: str) -> dict | None:
+    '''
+    Returns a previously cached API response if it is younger than the TTL.
+    Missing, unreadable or corrupt cache files are treated as a miss.
     '''
-    Merges the busy times for all attendees into one list.
+    try:
+        if time.time() - os.path.getmtime(cache_file) > CACHE_TTL_SECONDS:
+            return None
+        with open(cache_file, 'r', encoding='utf-8') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return None
+
+
+def write_query_cache(cache_file: str, calendars: dict,
+                      time_zones: list) -> None:
+    '''
+    Stores an API response so repeated runs can skip the network. Responses
+    with per-calendar errors are not cached, so a failed lookup is retried.
+    The file is written under a temporary name and moved into place, so an
+    interrupted or concurrent run never leaves a partial cache file behind.
+    '''
+    if any(calendar.get('errors') for calendar in calendars.values()):
+        return
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w',
+                                     encoding='utf-8',
+                                     dir=CACHE_PATH,
+                                     suffix='.tmp',
+                                     delete=False) as cache:
+        json.dump({'calendars': calendars, 'time_zones': time_zones}, cache)
+    os.replace(cache.name, cache_file)
+
+
+@functools.lru_cache(maxsize=32)
+def sort_time_zones(time_zone_list: tuple[str, ...]) -> tuple[str, ...]:
+    '''
+    Sorts time zones of attendees to normalize display of meeting times from latest
+    local time to earliest local time.
+    '''
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return tuple(
+        sorted(time_zone_list,
+               key=lambda time_zone: (-now.astimezone(
+                   zoneinfo.ZoneInfo(time_zone)).utcoffset(), time_zone)))
+
+
+@functools.lru_cache(maxsize=1)
+def construct_user_list(attendees: tuple) -> list:
+    '''
+    Converts tuple of atendees into dict expected by Google Calendar API.
+    '''
+    return [{'id': attendee} for attendee in attendees]
+
+
+def get_availability(
+        busy_times: list[dict]
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
     '''
+    Merges the busy times for all attendees into one sorted list of
+    non-overlapping (start, end) pairs.
+    '''
+    blocked_times = sorted(
+        (string_to_datetime(blocked['start']),
+         string_to_datetime(blocked['end'])) for calendar in busy_times
+        for blocked in busy_times[calendar]['busy'])
     merged_busy = []
-    for calendar in busy_times:
-        merged_busy += busy_times[calendar]['busy']
+    for blocked_start, blocked_end in blocked_times:
+        if merged_busy and blocked_start <= merged_busy[-1][1]:
+            merged_busy[-1] = (merged_busy[-1][0],
+                               max(merged_busy[-1][1], blocked_end))
+        else:
+            merged_busy.append((blocked_start, blocked_end))
     return merged_busy
 
 
-def round_to_half_hour(meeting_time: datetime.datetime) -> datetime.datetime:
+def round_to_half_hour(meeting_time: int) -> int:
     '''
-    If a meeting time is invalid, rolls next meeting to the top or bottom of the hour.
+    Rounds a time in whole UTC minutes since the epoch up to the next multiple
+    of 30, i.e. the next top or bottom of the hour. Aligned times are unchanged.
     '''
-    if meeting_time.minute not in (0, 30):
-        if meeting_time.minute < 30:
-            meeting_time = meeting_time.replace(minute=30)
-        else:
-            meeting_time = meeting_time.replace(minute=0)
-            meeting_time = meeting_time + datetime.timedelta(hours=1)
-    return meeting_time
+    return meeting_time + -meeting_time % 30
 
 
 def string_to_datetime(time_string: str) -> datetime.datetime:
     '''
-    Wrapper around strptime
+    Parses the RFC 3339 timestamps returned by the Google Calendar API.
+    fromisoformat only accepts a trailing 'Z' from Python 3.11 onwards.
+    '''
+    if time_string.endswith('Z'):
+        time_string = time_string[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(time_string)
+
+
+def datetime_to_minutes(moment: datetime.datetime,
+                        round_up: bool = False) -> int:
+    '''
+    Converts an aware datetime into whole minutes since the UTC epoch.
+    Rounds down unless round_up is set, e.g. for the end of a busy block.
+    '''
+    if round_up:
+        return math.ceil(moment.timestamp() / 60)
+    return int(moment.timestamp()) // 60
+
+
+def minutes_to_datetime(minutes: int) -> datetime.datetime:
+    '''
+    Converts minutes since the UTC epoch back into an aware UTC datetime.
+    '''
+    return datetime.datetime.fromtimestamp(minutes * 60,
+                                           tz=datetime.timezone.utc)
+
+
+def find_free_minutes(busy_starts: list[int], busy_ends: list[int],
+                      window_start: int, window_end: int,
+                      working_hours: list[tuple[int, int]], interval: int,
+                      duration: int) -> list[int]:
+    '''
+    Scheduling loop behind find_a_time. Every argument and result is in whole
+    UTC minutes, with busy blocks given as sorted, disjoint start/end lists.
     '''
-    return datetime.datetime.strptime(time_string, "%Y-%m-%dT%H:%M:%S%z")
+    meeting_minutes = []
+    for day_start, day_end in working_hours:
+        meeting_start = round_to_half_hour(max(day_start, window_start))
+        day_end = min(day_end, window_end)
+        while meeting_start + duration <= day_end:
+            # The busy blocks are disjoint, so the last one starting before
+            # the meeting ends is the only one that can overlap it.
+            index = bisect.bisect_left(busy_starts,
+                                       meeting_start + duration) - 1
+            if index >= 0 and meeting_start < busy_ends[index]:
+                meeting_start = round_to_half_hour(busy_ends[index])
+            else:
+                meeting_minutes.append(meeting_start)
+                meeting_start += interval
+    return meeting_minutes
 
 
-def find_a_time(availaibity: list[dict],
+def find_a_time(availaibity: list[tuple[datetime.datetime, datetime.datetime]],
                 start_time: datetime.datetime,
                 end_time: datetime.datetime,
-                earliest_start: datetime.datetime,
-                latest_finish: datetime.datetime,
+                working_hours: list[tuple[datetime.datetime,
+                                          datetime.datetime]],
                 interval: int = 30,
                 duration: int = 45):
     '''
-    Finds times where all attendees are avaialbe within the window.
-    '''
-    meeting_times = []
-    meeting_start_time = start_time
-    meeting_start_time = meeting_start_time.replace(minute=0,
-                                                    second=0,
-                                                    microsecond=0)
-    meeting_end_time = start_time + datetime.timedelta(minutes=duration)
-    while meeting_end_time < end_time:
-        meeting_start_time = round_to_half_hour(meeting_start_time)
-        if meeting_start_time.hour < earliest_start.hour:
-            meeting_start_time = meeting_start_time.replace(
-                hour=earliest_start.hour)
-            meeting_end_time = meeting_start_time + datetime.timedelta(
-                minutes=duration)
-        elif meeting_end_time.hour >= latest_finish.hour or meeting_end_time.day != meeting_start_time.day:
-            meeting_start_time = meeting_start_time + datetime.timedelta(
-                days=1)
-            meeting_start_time = meeting_start_time.replace(
-                hour=earliest_start.hour)
-            meeting_end_time = meeting_start_time + datetime.timedelta(
-                minutes=duration)
-        slot_available = True
-        for blocked in availaibity:
-            if string_to_datetime(blocked['start']
-                                  ) <= meeting_start_time < string_to_datetime(
-                                      blocked['end']):
-                slot_available = False
-                meeting_start_time = string_to_datetime(blocked['end'])
-                meeting_start_time = round_to_half_hour(meeting_start_time)
-                continue
-            if string_to_datetime(
-                    blocked['start']) <= meeting_end_time < string_to_datetime(
-                        blocked['end']):
-                slot_available = False
-                meeting_start_time = string_to_datetime(blocked['end'])
-                meeting_start_time = round_to_half_hour(meeting_start_time)
-                continue
-        if slot_available and meeting_start_time < end_time:
-            meeting_times.append(meeting_start_time)
-            meeting_start_time = meeting_start_time + datetime.timedelta(
-                minutes=interval)
-        meeting_end_time = meeting_start_time + datetime.timedelta(
-            minutes=duration)
-    return meeting_times
-
-
-def get_min_max_start(
-        time_zones: list[str]) -> tuple[datetime.datetime, datetime.datetime]:
-    '''
-    Gets the earliest and latest meeting times based on the time zones of the attendees.
-    '''
-    start_times = []
-    end_times = []
+    Finds times where all attendees are avaialbe within the window and the
+    working hours of each day.
+    '''
+    meeting_minutes = find_free_minutes(
+        [datetime_to_minutes(blocked_start) for blocked_start, _ in availaibity],
+        [
+            datetime_to_minutes(blocked_end, round_up=True)
+            for _, blocked_end in availaibity
+        ],
+        datetime_to_minutes(start_time), datetime_to_minutes(end_time),
+        [(datetime_to_minutes(day_start), datetime_to_minutes(day_end))
+         for day_start, day_end in working_hours], interval, duration)
+    return [minutes_to_datetime(minutes) for minutes in meeting_minutes]
+
+
+def get_zone_working_hours(
+        time_zone: str, first_day: datetime.date,
+        last_day: datetime.date) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    '''
+    Gets an attendee's working hours for each local weekday from first_day through last_day.
+    '''
+    preferences = load_preferences()
+    time_zone_info = zoneinfo.ZoneInfo(time_zone)
+    zone_hours = []
+    day = first_day
+    while day <= last_day:
+        if day.weekday() not in WEEKEND_DAYS_AS_INT:
+            zone_hours.append(
+                (datetime.datetime(day.year,
+                                   day.month,
+                                   day.day,
+                                   preferences['EarliestStart'],
+                                   tzinfo=time_zone_info),
+                 datetime.datetime(day.year,
+                                   day.month,
+                                   day.day,
+                                   preferences['LatestEnd'],
+                                   tzinfo=time_zone_info)))
+        day += datetime.timedelta(days=1)
+    return zone_hours
+
+
+def intersect_working_hours(
+    first_hours: list[tuple[datetime.datetime, datetime.datetime]],
+    second_hours: list[tuple[datetime.datetime, datetime.datetime]]
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    '''
+    Intersects two sorted lists of disjoint working intervals.
+    '''
+    shared_hours = []
+    first_index = second_index = 0
+    while first_index < len(first_hours) and second_index < len(second_hours):
+        first_start, first_end = first_hours[first_index]
+        second_start, second_end = second_hours[second_index]
+        shared_start = max(first_start, second_start)
+        shared_end = min(first_end, second_end)
+        if shared_start < shared_end:
+            shared_hours.append((shared_start, shared_end))
+        if first_end < second_end:
+            first_index += 1
+        else:
+            second_index += 1
+    return shared_hours
+
+
+def get_working_hours(
+    time_zones: list[str], start_time: datetime.datetime,
+    end_time: datetime.datetime
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    '''
+    Gets the working hours shared by all attendees within the window.
+    Each attendee's local weekdays are intersected as absolute time ranges, so
+    overlaps that fall on different local dates (e.g. across the date line)
+    are kept. Partial first and last days are clipped later by find_a_time.
+    '''
+    # A day either side covers every local date that can touch the window.
+    first_day = start_time.date() - datetime.timedelta(days=1)
+    last_day = end_time.date() + datetime.timedelta(days=1)
+    working_hours = None
     for time_zone in time_zones:
-        start_times.append(
-            datetime.datetime(2024,
-                              5,
-                              20,
-                              START_OF_DAY,
-                              tzinfo=zoneinfo.ZoneInfo(time_zone)))
-        end_times.append(
-            datetime.datetime(2024,
-                              5,
-                              20,
-                              END_OF_DAY,
-                              tzinfo=zoneinfo.ZoneInfo(time_zone)))
-    return max(start_times), min(end_times)
+        zone_hours = get_zone_working_hours(time_zone, first_day, last_day)
+        if working_hours is None:
+            working_hours = zone_hours
+        else:
+            working_hours = intersect_working_hours(working_hours, zone_hours)
+    return working_hours or []
 
 
 def main() -> None:
@@ -220,27 +387,30 @@ def main() -> None:
     print(
         "An automated script was used to generate a list of potential meeting times.",
         "Here's a list of emoji to select times that work for you!")
+    preferences = load_preferences()
+    emoji_options = load_emoji_options()
     start_time = EARLIEST_MEETING_TIME
-    end_time = start_time + datetime.timedelta(days=MEETING_WINDOW)
+    end_time = start_time + datetime.timedelta(
+        days=preferences['LengthOfMeetingWindow'])
     busy_times, time_zones = api_queries(start_time, end_time)
-    early_start, late_end = get_min_max_start(time_zones)
-    time_zones = sort_time_zones(time_zones)
+    working_hours = get_working_hours(time_zones, start_time, end_time)
+    time_zones = sort_time_zones(tuple(time_zones))
     meeting_times = find_a_time(get_availability(busy_times), start_time,
-                                end_time,
-                                early_start.astimezone(datetime.timezone.utc),
-                                late_end.astimezone(datetime.timezone.utc))
-    meeting_times = prune_weekends(meeting_times)
+                                end_time, working_hours)
+    time_zone_infos = [
+        zoneinfo.ZoneInfo(time_zone) for time_zone in time_zones
+    ]
     for i, meeting_time in enumerate(meeting_times):
         current_time = meeting_time
-        time_string = ""
-        for time_zone in time_zones:
-            time_string += f" {current_time.astimezone(zoneinfo.ZoneInfo(time_zone)).strftime('%I:%M%p %Z')}"
+        time_string = " ".join(
+            current_time.astimezone(time_zone_info).strftime('%I:%M%p %Z')
+            for time_zone_info in time_zone_infos)
         print(
-            f":{EMOJI_OPTIONS[(int(i))]}: {current_time.strftime('%a, %b %d')}:{time_string}"
+            f":{emoji_options[(int(i))]}: {current_time.strftime('%a, %b %d')}: {time_string}"
         )
-    if PREF_OPTIONS["IncludeNoAsOption"]:
+    if preferences["IncludeNoAsOption"]:
         print(
-            f"{PREF_OPTIONS['NoEmoji']} I'm extremely busy and won't be able to make it."
+            f"{preferences['NoEmoji']} I'm extremely busy and won't be able to make it."
         )
 
 